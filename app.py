@@ -1,13 +1,20 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import replicate
+import httpx
+import asyncio
 import os
-from PIL import Image
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps, UnidentifiedImageError
 import io
-import tempfile
 from dotenv import load_dotenv, find_dotenv
 import base64
-import uuid
+import hashlib
 import time
+from datetime import timedelta
+from types import MappingProxyType
+from typing import Mapping
 
 # Load environment variables from .env file
 load_dotenv(find_dotenv())
@@ -19,47 +26,272 @@ st.set_page_config(
     layout="wide"
 )
 
+# ----------------- Prompt Templates -----------------
+
+# LINE 貼圖風格對應的提示詞
+STICKER_STYLE_PROMPTS: Mapping[str, str] = MappingProxyType({
+    "可愛卡通": "識別圖片中的主要人物、角色或物體，並詳細描述其特徵（如外觀、表情、姿勢等）。將其轉換為可愛卡通風格的LINE貼圖，保持相同的角色和表情特徵。",
+    "簡約線條": "識別圖片中的主要人物、角色或物體，並詳細描述其特徵（如外觀、表情、姿勢等）。將其轉換為簡約線條風格的LINE貼圖，保持相同的角色和表情特徵。",
+    "表情豐富": "識別圖片中的主要人物、角色或物體，並詳細描述其特徵（如外觀、表情、姿勢等）。將其轉換為表情誇張生動的LINE貼圖，保持相同的角色和表情特徵。",
+    "動物角色": "識別圖片中的主要人物、角色或物體，並詳細描述其特徵（如外觀、表情、姿勢等）。將其轉換為可愛動物風格的LINE貼圖，保持相同的角色和表情特徵。",
+    "食物擬人化": "識別圖片中的主要人物、角色或物體，並詳細描述其特徵（如外觀、表情、姿勢等）。將其轉換為食物擬人化風格的LINE貼圖，保持相同的角色和表情特徵。"
+})
+DEFAULT_STICKER_PROMPT: str = "識別圖片中的主要人物、角色或物體，並詳細描述其特徵（如外觀、表情、姿勢等）。將其轉換為適合作為LINE貼圖的風格，保持相同的角色和表情特徵。"
+
 # ----------------- AI Service Functions -----------------
 
+# 同時向 Replicate 發出的請求上限
+MAX_CONCURRENT_REQUESTS = 8
+# 負責從文本分析生成圖片的工作者數量
+RENDER_WORKERS = 4
+# Flux-Schnell 單次請求最多可生成的圖片數量
+FLUX_MAX_OUTPUTS = 4
+# 文本分析相似度高於此值的圖片會合併成一次 Flux 請求
+ANALYSIS_SIMILARITY_THRESHOLD = 0.9
+# 即時顯示生成中文本的最短更新間隔（秒），與 Replicate 的輪詢間隔相同
+STREAM_UPDATE_INTERVAL = 0.5
+# 每個 session 保留的文本分析數量上限
+ANALYSIS_CACHE_MAX_ENTRIES = 128
+
+GEMMA_VERSION = "c0f0aebe8e578c15a7531e08a62cf01206f5870e9d0a67804b8152822db58c54"
+FLUX_MODEL = "black-forest-labs/flux-schnell"
+
+def image_prompt_key(image_bytes, prompt, temperature):
+    """以圖片內容、提示詞和溫度計算快取鍵"""
+    return hashlib.blake2b(image_bytes + prompt.encode() + str(temperature).encode()).hexdigest()
+
+# 相同的圖片、提示詞和參數直接重用上次的結果，不再重複呼叫 Replicate
+# 以底線開頭的參數不參與 Streamlit 的雜湊計算：圖片內容已由 cache_key 涵蓋
+@st.cache_data(show_spinner=False, max_entries=128)
+def cached_text_from_image(cache_key, version, _client, _image_bytes, prompt, temperature, _on_token=None):
+    image_file = io.BytesIO(_image_bytes)
+    image_file.name = "image.jpg"
+    prediction = _client.predictions.create(
+        version=version,
+        input={
+            "image": image_file,
+            "prompt": prompt,
+            "temperature": temperature,
+            "max_new_tokens": 512,
+            "top_p": 0.95,
+        }
+    )
+    
+    # 逐步取得 Gemma 輸出的 token，並限制更新頻率，避免每個 token 都重送整段文本到介面
+    tokens = []
+    last_update = 0.0
+    for token in prediction.output_iterator():
+        tokens.append(token)
+        if _on_token and time.monotonic() - last_update >= STREAM_UPDATE_INTERVAL:
+            _on_token("".join(tokens))
+            last_update = time.monotonic()
+    
+    text = "".join(tokens)
+    if _on_token:
+        _on_token(text)
+    return text
+
+# Replicate 約一小時後會刪除預測輸出，快取的圖片網址需在此之前過期，避免回傳失效的連結
+# num_outputs 也是快取鍵的一部分：批次合併後它取決於當時一起排入佇列的分析數量，
+# 因此相同的圖片在不同的分組下可能無法命中快取
+@st.cache_data(show_spinner=False, max_entries=128, ttl=timedelta(minutes=50))
+def cached_image_from_text(model, _client, text_prompt, num_inference_steps, aspect_ratio, num_outputs, _on_output=None):
+    prediction = _client.models.predictions.create(
+        model=model,
+        input={
+            "prompt": text_prompt,
+            "num_outputs": num_outputs,
+            "aspect_ratio": aspect_ratio,
+            "output_format": "png",
+            "num_inference_steps": num_inference_steps,
+        }
+    )
+    
+    # 每張圖片完成後立即回報，不必等待所有 num_outputs 都生成完畢
+    image_output = []
+    for image_url in prediction.output_iterator():
+        if _on_output:
+            _on_output(len(image_output), image_url)
+        image_output.append(image_url)
+    return image_output
+
+def show_live_image(placeholder, image_url):
+    placeholder.image(image_url, use_container_width=True)
+
+def run_in_thread(func, *args):
+    """在執行緒中執行阻塞呼叫，並附上目前的 ScriptRunContext，讓 st.cache_data 在執行緒中也能讀寫快取"""
+    ctx = get_script_run_ctx()
+    
+    def run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return func(*args)
+    
+    return asyncio.to_thread(run)
+
+async def run_in_thread_streaming(func, *args, on_item=None):
+    """與 run_in_thread 相同，並將 func 透過最後一個參數回報的項目交由 on_item 在協程中處理
+    
+    工作執行緒只把項目放入佇列，所有 st 呼叫都在協程中進行，
+    讓使用者中途操作時 Streamlit 拋出的 RerunException / StopException 能傳回 asyncio.run
+    """
+    if on_item is None:
+        return await run_in_thread(func, *args, None)
+    
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+    
+    def emit(*item):
+        loop.call_soon_threadsafe(items.put_nowait, item)
+    
+    task = asyncio.ensure_future(run_in_thread(func, *args, emit))
+    try:
+        while not task.done():
+            next_item = asyncio.ensure_future(items.get())
+            await asyncio.wait({task, next_item}, return_when=asyncio.FIRST_COMPLETED)
+            if next_item.done():
+                on_item(*next_item.result())
+            else:
+                next_item.cancel()
+        
+        # 執行緒結束前送出的項目都已在佇列中
+        while not items.empty():
+            on_item(*items.get_nowait())
+    except BaseException:
+        task.cancel()
+        raise
+    
+    return task.result()
+
 class AIService:
     def __init__(self, api_token):
-        self.client = replicate.Client(api_token=api_token)
+        # 共用可重複使用連線的 HTTP/2 連線池，避免每次呼叫重新進行 TCP/TLS 握手
+        # 所有呼叫都透過同步 client 在執行緒中進行，因此只需提供同步的 transport
+        self.client = replicate.Client(
+            api_token=api_token,
+            timeout=httpx.Timeout(300.0),
+            transport=httpx.HTTPTransport(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+                retries=2
+            )
+        )
+        
+    async def generate_text_from_image(self, image_bytes, prompt, temperature=0.7, placeholder=None):
+        """使用 Gemma-3-27b-it 從圖片生成文本，若提供 placeholder 則即時顯示生成中的文本"""
+        on_token = None
+        shown_text = None
+        if placeholder is not None:
+            def on_token(text):
+                nonlocal shown_text
+                shown_text = text
+                placeholder.markdown(text)
         
-    def generate_text_from_image(self, image_path, prompt, temperature=0.7):
-        """使用 Gemma-3-27b-it 從圖片生成文本"""
         try:
-            text_output = self.client.run(
-                "google-deepmind/gemma-3-27b-it:c0f0aebe8e578c15a7531e08a62cf01206f5870e9d0a67804b8152822db58c54",
-                input={
-                    "image": open(image_path, "rb"),
-                    "prompt": prompt,
-                    "temperature": temperature,
-                    "max_new_tokens": 512,
-                    "top_p": 0.95,
-                }
+            # Replicate 呼叫為阻塞操作，交給執行緒執行以便多張圖片的請求可以同時進行
+            text_output = await run_in_thread_streaming(
+                cached_text_from_image,
+                image_prompt_key(image_bytes, prompt, temperature),
+                GEMMA_VERSION,
+                self.client,
+                image_bytes,
+                prompt,
+                temperature,
+                on_item=on_token
             )
-            return "".join(text_output)
         except Exception as e:
             st.error(f"文本生成失敗: {str(e)}")
             return None
+        
+        # 命中快取時不會逐步回報，直接顯示完整的文本
+        if placeholder is not None and text_output and text_output != shown_text:
+            placeholder.markdown(text_output)
+        return text_output
     
-    def generate_image_from_text(self, text_prompt, num_outputs=1, num_inference_steps=3, aspect_ratio="1:1"):
-        """使用 Flux-Schnell 從文本生成圖片"""
+    async def generate_image_from_text(self, text_prompt, num_outputs=1, num_inference_steps=3, aspect_ratio="1:1", placeholders=None):
+        """使用 Flux-Schnell 從文本生成圖片，若提供 placeholders 則每張圖片完成時即時顯示"""
+        on_output = None
+        streamed = set()
+        if placeholders is not None:
+            def on_output(index, image_url):
+                streamed.add(index)
+                show_live_image(placeholders[index], image_url)
+        
         try:
-            image_output = self.client.run(
-                "black-forest-labs/flux-schnell",
-                input={
-                    "prompt": text_prompt,
-                    "num_outputs": num_outputs,
-                    "aspect_ratio": aspect_ratio,
-                    "output_format": "png",
-                    "num_inference_steps": num_inference_steps,
-                }
+            image_output = await run_in_thread_streaming(
+                cached_image_from_text,
+                FLUX_MODEL,
+                self.client,
+                text_prompt,
+                num_inference_steps,
+                aspect_ratio,
+                num_outputs,
+                on_item=on_output
             )
-            return image_output
         except Exception as e:
             st.error(f"圖像生成失敗: {str(e)}")
             return None
+        
+        # 命中快取時不會逐張回報，補上尚未顯示的結果
+        if placeholders is not None:
+            for index, (placeholder, image_url) in enumerate(zip(placeholders, image_output)):
+                if index not in streamed:
+                    show_live_image(placeholder, image_url)
+        return image_output
+    
+    def warm_up_flux(self):
+        """在背景發出最小的 Flux 請求，讓模型在使用者開始處理前完成冷啟動"""
+        def run():
+            try:
+                self.client.run(
+                    FLUX_MODEL,
+                    input={
+                        "prompt": "warmup",
+                        "num_outputs": 1,
+                        "num_inference_steps": 1,
+                    }
+                )
+            except Exception:
+                # 預熱失敗不影響正式請求
+                pass
+        
+        threading.Thread(target=run, daemon=True).start()
+
+# ----------------- Image Processing -----------------
+
+# 上傳給 Gemma 前圖片最長邊的像素上限
+MAX_IMAGE_EDGE = 1024
+
+def prepare_image_for_upload(raw_bytes):
+    """縮小並以 JPEG 重新壓縮上傳的圖片，減少傳送給 Gemma 的資料量"""
+    image = Image.open(io.BytesIO(raw_bytes))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.LANCZOS)
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        # JPEG 不支援透明度，將透明背景合成為白色，避免變成黑底
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=85, optimize=True)
+    return buffer.getvalue()
+
+def prepare_uploaded_file(uploaded_file):
+    """計算上傳圖片的ID並縮圖壓縮，回傳 (圖片ID, 圖片內容)；空白或無法解碼的檔案回傳 None"""
+    raw_bytes = uploaded_file.getvalue()
+    if not raw_bytes:
+        return None
+    
+    try:
+        image_bytes = prepare_image_for_upload(raw_bytes)
+    except (UnidentifiedImageError, OSError):
+        return None
+    
+    # 以圖片內容的雜湊作為ID，重複上傳相同的圖片時可以命中各項快取
+    return hashlib.blake2b(raw_bytes, digest_size=16).hexdigest(), image_bytes
 
 # ----------------- Session State Initialization -----------------
 
@@ -76,6 +308,19 @@ def init_session_state():
     if 'uploaded_images' not in st.session_state:
         st.session_state.uploaded_images = []
     
+    if 'flux_warmed' not in st.session_state:
+        st.session_state.flux_warmed = False
+    
+    if 'image_pool' not in st.session_state:
+        # PIL 在解碼和編碼時會釋放 GIL，多張圖片可以用執行緒平行處理
+        st.session_state.image_pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+    
+    if 'prepared_images' not in st.session_state:
+        st.session_state.prepared_images = {}
+    
+    if 'analysis_cache' not in st.session_state:
+        st.session_state.analysis_cache = {}
+    
     if 'image_analyses' not in st.session_state:
         st.session_state.image_analyses = {}
     
@@ -125,8 +370,8 @@ def render_sidebar():
             "圖像生成質量",
             min_value=1,
             max_value=4,
-            value=3,
-            help="步數越多，生成的圖像質量越高，但需要更長時間"
+            value=2 if line_sticker_mode else 3,
+            help="步數越多，生成的圖像質量越高，但需要更長時間。LINE 貼圖風格較簡單，2 步即可達到穩定的效果"
         )
         
         num_images = st.slider(
@@ -154,7 +399,7 @@ def render_sidebar():
         if line_sticker_mode:
             sticker_style = st.selectbox(
                 "貼圖風格",
-                options=["可愛卡通", "簡約線條", "表情豐富", "動物角色", "食物擬人化"],
+                options=list(STICKER_STYLE_PROMPTS),
                 index=0,
                 help="選擇 LINE 貼圖的視覺風格"
             )
@@ -179,24 +424,43 @@ def render_image_uploader():
     
     if uploaded_files:
         st.session_state.uploaded_images = []
+        # 每個上傳檔案只計算ID和縮圖壓縮一次，之後的 rerun 直接重用結果
+        prepared_images = {
+            uploaded_file.file_id: st.session_state.prepared_images[uploaded_file.file_id]
+            for uploaded_file in uploaded_files
+            if uploaded_file.file_id in st.session_state.prepared_images
+        }
+        
+        # 新上傳的圖片在執行緒池中平行解碼和縮圖
+        new_files = [uploaded_file for uploaded_file in uploaded_files if uploaded_file.file_id not in prepared_images]
+        if new_files:
+            results = st.session_state.image_pool.map(prepare_uploaded_file, new_files)
+            for uploaded_file, prepared in zip(new_files, results):
+                prepared_images[uploaded_file.file_id] = prepared
         
         for uploaded_file in uploaded_files:
-            # 為每個上傳的圖片生成唯一ID
-            image_id = str(uuid.uuid4())
+            prepared = prepared_images[uploaded_file.file_id]
+            if prepared is None:
+                st.warning(f"無法讀取圖片「{uploaded_file.name}」，已略過")
+                continue
             
-            # 儲存圖片到臨時目錄
-            image = Image.open(uploaded_file)
-            temp_dir = tempfile.mkdtemp()
-            temp_path = os.path.join(temp_dir, f"{image_id}.png")
-            image.save(temp_path, format="PNG")
+            # 相同內容的圖片只處理一次
+            image_id, image_bytes = prepared
+            if any(img_data["id"] == image_id for img_data in st.session_state.uploaded_images):
+                continue
             
-            # 添加到上傳的圖片列表
             st.session_state.uploaded_images.append({
                 "id": image_id,
                 "name": uploaded_file.name,
-                "path": temp_path,
-                "temp_dir": temp_dir
+                "bytes": image_bytes
             })
+        
+        st.session_state.prepared_images = prepared_images
+        
+        # 上傳後即預熱 Flux，使用者調整參數的同時模型完成冷啟動
+        if not st.session_state.flux_warmed:
+            st.session_state.ai_service.warm_up_flux()
+            st.session_state.flux_warmed = True
     
     # 顯示所有上傳的圖片
     if st.session_state.uploaded_images:
@@ -205,7 +469,152 @@ def render_image_uploader():
         cols = st.columns(min(3, len(st.session_state.uploaded_images)))
         for i, img_data in enumerate(st.session_state.uploaded_images):
             with cols[i % 3]:
-                st.image(img_data["path"], caption=f"圖片 {i+1}: {img_data['name']}", use_container_width=True)
+                st.image(img_data["bytes"], caption=f"圖片 {i+1}: {img_data['name']}", use_container_width=True)
+
+def build_effective_prompt(params):
+    # 根據 LINE 貼圖模式調整提示詞
+    effective_prompt = params["prompt"]
+    if params["line_sticker_mode"]:
+        style_prompt = STICKER_STYLE_PROMPTS.get(params["sticker_style"], DEFAULT_STICKER_PROMPT)
+        effective_prompt = f"{effective_prompt} {style_prompt}"
+    return effective_prompt
+
+def build_generation_prompt(text_analysis, params):
+    # 為 LINE 貼圖模式增強生成提示
+    generation_prompt = text_analysis
+    if params["line_sticker_mode"]:
+        # 從文本分析中提取關鍵元素
+        key_elements = text_analysis.split("。")[0] if "。" in text_analysis else text_analysis
+        
+        # 強化保持原始圖片元素的提示
+        sticker_enhancement = f"""
+        Create a LINE sticker featuring the exact same character/object as in the original image: {key_elements}
+        Style: {params["sticker_style"] if params["sticker_style"] else "cute cartoon"}
+        Must maintain the identity and key features of the original subject
+        Simple clear design with white or transparent background
+        Expressive and emotionally clear for messaging
+        Digital art style suitable for LINE stickers
+        """
+        
+        # 合併提示，確保保留原始圖片元素
+        generation_prompt = f"{key_elements} - {sticker_enhancement}"
+    return generation_prompt
+
+def text_similarity(a, b):
+    """以字元 3-gram 的 Jaccard 相似度比較兩段文本"""
+    shingles_a = {a[i:i + 3] for i in range(max(1, len(a) - 2))}
+    shingles_b = {b[i:i + 3] for i in range(max(1, len(b) - 2))}
+    return len(shingles_a & shingles_b) / len(shingles_a | shingles_b)
+
+def group_similar_analyses(analyses, max_group_size):
+    """將相同或高度相似的 (圖片ID, 文本分析) 分為同一組，每組最多 max_group_size 個"""
+    groups = []
+    for image_id, text_analysis in analyses:
+        for group in groups:
+            if len(group) < max_group_size and text_similarity(group[0][1], text_analysis) > ANALYSIS_SIMILARITY_THRESHOLD:
+                group.append((image_id, text_analysis))
+                break
+        else:
+            groups.append([(image_id, text_analysis)])
+    return groups
+
+async def run_pipelines(params, progress_bar, text_placeholders, image_placeholders):
+    ai_service = st.session_state.ai_service
+    total_steps = len(st.session_state.uploaded_images) * (1 + params["num_images"])
+    completed_steps = 0
+    progress_lock = asyncio.Lock()
+    # 限制同時進行的 Replicate 請求數量，避免觸發 API 速率限制
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    
+    async def advance(steps):
+        nonlocal completed_steps
+        async with progress_lock:
+            completed_steps += steps
+            progress_bar.progress(completed_steps / total_steps)
+    
+    # 第一階段產生的 (圖片ID, 文本分析) 會放入佇列，由第二階段的工作者取出生成圖片，
+    # 讓已完成分析的圖片可以先生成新圖像，不必等待其他圖片的文本分析
+    analysis_queue = asyncio.Queue()
+    
+    async def analyze(img_data):
+        effective_prompt = build_effective_prompt(params)
+        
+        # 只切換貼圖風格時重用上次的分析，直接重新生成圖片：
+        # 風格會另外寫入 Flux 的提示詞，因此快取鍵不包含風格對應的提示詞
+        cache_key = (img_data["id"], params["prompt"], params["line_sticker_mode"], round(params["temperature"], 2))
+        text_analysis = st.session_state.analysis_cache.get(cache_key)
+        
+        if text_analysis is None:
+            # 生成文本分析
+            async with semaphore:
+                text_analysis = await ai_service.generate_text_from_image(
+                    img_data["bytes"],
+                    effective_prompt,
+                    params["temperature"],
+                    placeholder=text_placeholders[img_data["id"]]
+                )
+            
+            if text_analysis:
+                analysis_cache = st.session_state.analysis_cache
+                analysis_cache[cache_key] = text_analysis
+                # 超過上限時移除最早加入的分析
+                while len(analysis_cache) > ANALYSIS_CACHE_MAX_ENTRIES:
+                    del analysis_cache[next(iter(analysis_cache))]
+        else:
+            text_placeholders[img_data["id"]].markdown(text_analysis)
+        
+        if text_analysis:
+            st.session_state.image_analyses[img_data["id"]] = text_analysis
+            await advance(1)
+            await analysis_queue.put((img_data["id"], text_analysis))
+    
+    async def render_group(group):
+        # 同一組的圖片共用組內第一個分析的提示詞，以一次 Flux 請求生成所有圖片
+        num_images = params["num_images"]
+        async with semaphore:
+            generated_images = await ai_service.generate_image_from_text(
+                build_generation_prompt(group[0][1], params),
+                num_outputs=num_images * len(group),
+                num_inference_steps=params["num_inference_steps"],
+                aspect_ratio=params["aspect_ratio"],
+                placeholders=[placeholder for image_id, _ in group for placeholder in image_placeholders[image_id]]
+            )
+        
+        if generated_images:
+            for index, (image_id, _) in enumerate(group):
+                st.session_state.generated_images[image_id] = generated_images[index * num_images:(index + 1) * num_images]
+            await advance(num_images * len(group))
+    
+    async def render_worker():
+        while True:
+            item = await analysis_queue.get()
+            if item is None:
+                return
+            
+            # 一併取出佇列中已完成的分析，讓相似的分析可以合併成一次 Flux 請求
+            pending = [item]
+            while not analysis_queue.empty():
+                extra = analysis_queue.get_nowait()
+                if extra is None:
+                    # 結束訊號屬於其他工作者，放回佇列
+                    analysis_queue.put_nowait(None)
+                    break
+                pending.append(extra)
+            
+            # 生成指定數量的新圖片
+            max_group_size = max(1, FLUX_MAX_OUTPUTS // params["num_images"])
+            groups = group_similar_analyses(pending, max_group_size)
+            await asyncio.gather(*(render_group(group) for group in groups))
+    
+    async def close_queue(stage_a, num_workers):
+        # 所有文本分析完成後，通知每個工作者結束
+        await asyncio.gather(*stage_a)
+        for _ in range(num_workers):
+            await analysis_queue.put(None)
+    
+    stage_a = [asyncio.create_task(analyze(img_data)) for img_data in st.session_state.uploaded_images]
+    stage_b = [asyncio.create_task(render_worker()) for _ in range(min(RENDER_WORKERS, len(stage_a)))]
+    await asyncio.gather(*stage_a, *stage_b, close_queue(stage_a, len(stage_b)))
 
 def process_images(params):
     if not st.session_state.uploaded_images:
@@ -215,73 +624,25 @@ def process_images(params):
     with st.spinner("🤖 AI 正在處理您的圖片..."):
         # 初始化進度條
         progress_bar = st.progress(0)
-        total_steps = len(st.session_state.uploaded_images) * (1 + params["num_images"])
-        completed_steps = 0
         
         # 清空舊的分析結果
         st.session_state.image_analyses = {}
         st.session_state.generated_images = {}
         
-        # 處理每張上傳的圖片
-        for img_data in st.session_state.uploaded_images:
-            # 根據 LINE 貼圖模式調整提示詞
-            effective_prompt = params["prompt"]
-            if params["line_sticker_mode"]:
-                sticker_style_prompts = {
-                    "可愛卡通": "識別圖片中的主要人物、角色或物體，並詳細描述其特徵（如外觀、表情、姿勢等）。將其轉換為可愛卡通風格的LINE貼圖，保持相同的角色和表情特徵。",
-                    "簡約線條": "識別圖片中的主要人物、角色或物體，並詳細描述其特徵（如外觀、表情、姿勢等）。將其轉換為簡約線條風格的LINE貼圖，保持相同的角色和表情特徵。",
-                    "表情豐富": "識別圖片中的主要人物、角色或物體，並詳細描述其特徵（如外觀、表情、姿勢等）。將其轉換為表情誇張生動的LINE貼圖，保持相同的角色和表情特徵。",
-                    "動物角色": "識別圖片中的主要人物、角色或物體，並詳細描述其特徵（如外觀、表情、姿勢等）。將其轉換為可愛動物風格的LINE貼圖，保持相同的角色和表情特徵。",
-                    "食物擬人化": "識別圖片中的主要人物、角色或物體，並詳細描述其特徵（如外觀、表情、姿勢等）。將其轉換為食物擬人化風格的LINE貼圖，保持相同的角色和表情特徵。"
-                }
-                style_prompt = sticker_style_prompts.get(params["sticker_style"], "識別圖片中的主要人物、角色或物體，並詳細描述其特徵（如外觀、表情、姿勢等）。將其轉換為適合作為LINE貼圖的風格，保持相同的角色和表情特徵。")
-                effective_prompt = f"{effective_prompt} {style_prompt}"
-            
-            # 生成文本分析
-            text_analysis = st.session_state.ai_service.generate_text_from_image(
-                img_data["path"],
-                effective_prompt,
-                params["temperature"]
-            )
-            
-            if text_analysis:
-                st.session_state.image_analyses[img_data["id"]] = text_analysis
-                completed_steps += 1
-                progress_bar.progress(completed_steps / total_steps)
-                
-                # 為 LINE 貼圖模式增強生成提示
-                generation_prompt = text_analysis
-                if params["line_sticker_mode"]:
-                    # 從文本分析中提取關鍵元素
-                    key_elements = text_analysis.split("。")[0] if "。" in text_analysis else text_analysis
-                    
-                    # 強化保持原始圖片元素的提示
-                    sticker_enhancement = f"""
-                    Create a LINE sticker featuring the exact same character/object as in the original image: {key_elements}
-                    Style: {params["sticker_style"] if params["sticker_style"] else "cute cartoon"}
-                    Must maintain the identity and key features of the original subject
-                    Simple clear design with white or transparent background
-                    Expressive and emotionally clear for messaging
-                    Digital art style suitable for LINE stickers
-                    """
-                    
-                    # 合併提示，確保保留原始圖片元素
-                    generation_prompt = f"{key_elements} - {sticker_enhancement}"
-                
-                # 生成指定數量的新圖片
-                generated_images = st.session_state.ai_service.generate_image_from_text(
-                    generation_prompt,
-                    num_outputs=params["num_images"],
-                    num_inference_steps=params["num_inference_steps"],
-                    aspect_ratio=params["aspect_ratio"]
-                )
-                
-                if generated_images:
-                    st.session_state.generated_images[img_data["id"]] = generated_images
-                    completed_steps += params["num_images"]
-                    progress_bar.progress(completed_steps / total_steps)
+        # 為每張圖片建立即時顯示文本分析和生成圖片的區塊
+        live_output = st.empty()
+        text_placeholders = {}
+        image_placeholders = {}
+        with live_output.container():
+            for i, img_data in enumerate(st.session_state.uploaded_images):
+                st.markdown(f"##### 📝 圖片 {i+1}: {img_data['name']}")
+                text_placeholders[img_data["id"]] = st.empty()
+                image_placeholders[img_data["id"]] = [col.empty() for col in st.columns(params["num_images"])]
         
-        # 完成
+        asyncio.run(run_pipelines(params, progress_bar, text_placeholders, image_placeholders))
+        
+        # 完成後改由 display_results 顯示完整結果
+        live_output.empty()
         progress_bar.progress(1.0)
         st.success("✨ 所有圖片處理完成！")
 
@@ -305,7 +666,7 @@ def display_results():
         col1, col2 = st.columns([1, 2])
         
         with col1:
-            st.image(img_data["path"], caption="原始圖片", use_container_width=True)
+            st.image(img_data["bytes"], caption="原始圖片", use_container_width=True)
         
         with col2:
             st.markdown("##### 📝 生成的文本分析")
@@ -337,15 +698,6 @@ def display_results():
                             # 添加下載按鈕
                             st.markdown(f"[下載圖片]('{img_url}')")
 
-def cleanup_temp_files():
-    # 清理臨時文件
-    for img_data in st.session_state.uploaded_images:
-        try:
-            os.remove(img_data["path"])
-            os.rmdir(img_data["temp_dir"])
-        except Exception:
-            pass
-
 # ----------------- Main Application -----------------
 
 def main():
@@ -381,7 +733,3 @@ if __name__ == "__main__":
         main()
     except Exception as e:
         st.error(f"應用程序發生錯誤: {str(e)}")
-    finally:
-        # 清理臨時文件
-        if 'uploaded_images' in st.session_state:
-            cleanup_temp_files()